@@ -5,17 +5,25 @@ Template Component main class.
 import csv
 import json
 import logging
+from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 import os
+import queue
 import shutil
-import io
-import zipfile
+import threading
 
+import orjson
+import pyarrow as pa
+from pyarrow import csv as pac
 from csv2json.hone_csv2json import Csv2JsonConverter
 from keboola.component.base import ComponentBase
 from keboola.component.dao import TableDefinition
 from keboola.component.exceptions import UserException
 from uploader.client import S3Writer
+from zip_writer import ShopZipWriterPool
 
 # configuration variables
 KEY_FORMAT = 'format'
@@ -24,8 +32,20 @@ AWS_SECRET_ACCESS_KEY = '#aws_secret_access_key'
 AWS_ACCESS_KEY_ID = 'aws_access_key_id'
 AWS_BUCKET = "aws_bucket"
 S3_BUCKET_DIR = "aws_directory"
+KEY_DEBUG = "debug"
+KEY_VALIDATE_JSON = "validate_json"
+KEY_WORKERS = "workers"
+KEY_COMPRESSLEVEL = "compresslevel"
+
+DEFAULT_WORKERS = 16
+DEFAULT_COMPRESSLEVEL = 1
+COMPRESSLEVELS = range(0, 4)  # DEFLATE levels supported by ISA-L
 
 MAX_FILES_PER_ZIP = 200_000  # Maximum number of files per zip file
+MAX_OPEN_ZIPS = 256  # Maximum number of zip files open at the same time
+SHARD_QUEUE_SIZE = 4  # Maximum number of row groups waiting for a price history writer thread
+CSV_BLOCK_SIZE = 16 << 20  # Size of the CSV blocks parsed by the streaming reader
+CSV_READ_BUFFER = 1 << 20  # Read buffer size of the CSV files parsed by the csv module
 
 
 # list of mandatory parameters => if some is missing,
@@ -43,8 +63,6 @@ class Component(ComponentBase):
         self.validate_configuration_parameters(REQUIRED_PARAMETERS)
         params = self.configuration.parameters
         self.upload_processor = None
-        self.target_paths = None
-        self.local_paths = None
 
         if params.get(KEY_OVERRIDE, False):
             self.s3_bucket_dir = params.get(S3_BUCKET_DIR)
@@ -62,6 +80,16 @@ class Component(ComponentBase):
             logging.info(f"Format setting is: {params.get(KEY_FORMAT)}")
 
         self.custom_mapping = [] if params.get("field_datatypes") is None else params.get("field_datatypes")
+        # the json column is passed through as-is, it is only parsed when validation is requested or in debug mode
+        self.validate_json = params.get(KEY_VALIDATE_JSON, False) or params.get(KEY_DEBUG, False)
+        self.workers = DEFAULT_WORKERS if params.get(KEY_WORKERS) is None else params.get(KEY_WORKERS)
+        if type(self.workers) is not int or self.workers < 1:
+            raise UserException(f"Wrong parameter {KEY_WORKERS}: {self.workers}. Viable values are positive integers")
+        self.compresslevel = params.get(KEY_COMPRESSLEVEL, DEFAULT_COMPRESSLEVEL)
+        # bool is a subclass of int and floats equal to a level pass the range check, both fail in zipfile
+        if type(self.compresslevel) is not int or self.compresslevel not in COMPRESSLEVELS:
+            raise UserException(f"Wrong parameter {KEY_COMPRESSLEVEL}: {self.compresslevel}. "
+                                f"Viable values are: {COMPRESSLEVELS.start}-{COMPRESSLEVELS.stop - 1}")
 
     def run(self):
         """
@@ -71,22 +99,25 @@ class Component(ComponentBase):
         input_tables = self.get_input_tables_definitions()
 
         self.upload_processor = S3Writer(self.configuration.parameters, self.files_out_path,
-                                         aws_bucket=self.aws_bucket)
+                                         aws_bucket=self.aws_bucket, workers=self.workers)
 
         if not self.upload_processor.test_connection_ok():
             logging.error("Connection check failed. Connection is not possible or your account does not have "
-                          "READ_ACP rights.")
-
-        for table in input_tables:
-            _format = self.configuration.parameters[KEY_FORMAT]
-            logging.info(f"Processing table {table.name} using format: {_format}")
-            if _format == 'pricehistory':
-                self._generate_price_history(table)
-            elif _format == 'metadata':
-                self._generate_metadata(table)
-            else:
-                raise UserException(f"Wrong parameter in data/config_pricehistory.json {_format}. "
-                                    "Viable parameters are: pricehistory/metadata")
+                          "access to the bucket.")
+
+        try:
+            for table in input_tables:
+                _format = self.configuration.parameters[KEY_FORMAT]
+                logging.info(f"Processing table {table.name} using format: {_format}")
+                if _format == 'pricehistory':
+                    self._generate_price_history(table)
+                elif _format == 'metadata':
+                    self._generate_metadata(table)
+                else:
+                    raise UserException(f"Wrong parameter in data/config_pricehistory.json {_format}. "
+                                        "Viable parameters are: pricehistory/metadata")
+        finally:
+            self.upload_processor.close()
 
         self.output_folder_cleanup()
         logging.info(f"Parsing finished successfully. "
@@ -94,10 +125,8 @@ class Component(ComponentBase):
 
     @staticmethod
     def _validate_expected_columns(table_type, table: TableDefinition, expected_columns: List[str]):
-        errors = []
-        for c in expected_columns:
-            if c not in table.columns:
-                errors.append(c)
+        columns = set(table.columns)
+        errors = [c for c in expected_columns if c not in columns]
 
         if errors:
             error = f'Some required columns are missing for format {table_type}. ' \
@@ -105,202 +134,207 @@ class Component(ComponentBase):
             raise UserException(error)
 
     def output_folder_cleanup(self) -> None:
-        dir_to_clean = self.files_out_path
-        for files in os.listdir(dir_to_clean):
-            path = os.path.join(dir_to_clean, files)
-            try:
-                shutil.rmtree(path)
-            except OSError:
-                os.remove(path)
+        shutil.rmtree(self.files_out_path, ignore_errors=True)
+        os.makedirs(self.files_out_path, exist_ok=True)
 
-    @staticmethod
-    def _write_json_content_to_zip(zip_file, file_path, content):
-        with io.BytesIO() as file_buffer:
-            # Write JSON content to the in-memory file buffer
-            json_str = json.dumps(content, ensure_ascii=False)
-            file_buffer.write(json_str.encode('utf-8'))
-            file_buffer.seek(0)
-
-            # Add the in-memory file to the zip file
-            zip_file.writestr(file_path, file_buffer.getvalue())
+    def _validated_json(self, file_path: str, json_str: str) -> bytes:
+        """
+        Returns an already serialized JSON string as bytes, skipping the parse/serialize round-trip.
+        """
+        if self.validate_json:
+            try:
+                orjson.loads(json_str)
+            except orjson.JSONDecodeError as e:
+                raise UserException(f"Invalid JSON content for {file_path}: {e}") from e
+        return json_str.encode('utf-8')
 
     def _generate_price_history(self, table: TableDefinition):
         expected_columns = ['shop_id', 'slug', 'json']
         self._validate_expected_columns('pricehistory', table, expected_columns)
 
-        # Create a dictionary to store the zip files by shop_id
-        zip_files = {}
+        # every shop is always routed to the same shard, so each shard thread owns its archives exclusively;
+        # shops are assigned to shards round-robin in order of appearance and MAX_OPEN_ZIPS is split between
+        # the shards the same way, so all archives stay open as long as the table has at most MAX_OPEN_ZIPS shops
+        shards = min(self.workers, MAX_OPEN_ZIPS)
+        shard_of_shop = {}
+        shard_queues = [queue.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in range(shards)]
+        shard_writers = [ShopZipWriterPool(self.files_out_path, 'pricehistory', MAX_FILES_PER_ZIP,
+                                           MAX_OPEN_ZIPS // shards + (1 if shard < MAX_OPEN_ZIPS % shards else 0),
+                                           compresslevel=self.compresslevel, on_close=self._upload_archive)
+                         for shard in range(shards)]
+        aborted = threading.Event()
+
+        # finished archives are uploaded while the rest of the table is being processed
+        self.upload_processor.start_background_upload()
 
         logging.info("Writing json content.")
-        file_count = 0
-        zip_nr_suffix = 1
-        for row in self.read_csv_file(table.full_path):
-            shop_id = row["shop_id"]
-
-            if shop_id not in zip_files:
-                # Define the suffix for the zip file
-                suffix = "_pricehistory_1"
-                zip_filename = os.path.join(self.files_out_path, f'{shop_id}{suffix}.zip')
-                zip_files[shop_id] = zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED)
-                file_count = 0
-
-            # Remove the top-level folder by excluding the `{row["shop_id"]}` part
-            file_path = f'items/{row["shop_id"]}/{row["slug"]}/price-history.json'
-            content = json.loads(row['json'])
-            self._write_json_content_to_zip(zip_files[shop_id], file_path, content)
-
-            file_count += 1
-            if file_count >= MAX_FILES_PER_ZIP:
-                # Close the current zip file and create a new one
-                zip_files[shop_id].close()
-                suffix = f"_pricehistory_{zip_nr_suffix}"
-                zip_filename = os.path.join(self.files_out_path, f'{shop_id}{suffix}.zip')
-                zip_files[shop_id] = zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED)
-                file_count = 0
-                zip_nr_suffix += 1
-
-        # Close the zip files
-        for zip_file in zip_files.values():
-            zip_file.close()
+        try:
+            with ThreadPoolExecutor(max_workers=shards) as executor:
+                futures = [executor.submit(self._write_price_history_shard, shard_queue, zip_writers, aborted)
+                           for shard_queue, zip_writers in zip(shard_queues, shard_writers)]
+                try:
+                    for shop_ids, slugs, json_strs in self.read_csv_batches(table.full_path, expected_columns):
+                        if aborted.is_set():
+                            break
+                        rows_by_shop = defaultdict(list)
+                        for shop_id, slug, json_str in zip(shop_ids, slugs, json_strs):
+                            rows_by_shop[shop_id].append((slug, json_str))
+                        for shop_id, rows in rows_by_shop.items():
+                            shard = shard_of_shop.setdefault(shop_id, len(shard_of_shop) % shards)
+                            shard_queues[shard].put((shop_id, rows))
+                except BaseException:
+                    aborted.set()
+                    raise
+                finally:
+                    for shard_queue in shard_queues:
+                        shard_queue.put(None)
+
+                for future in futures:
+                    future.result()
+
+            # the zip files are closed only once all shards succeeded, so a failed run uploads no final archives
+            for zip_writers in shard_writers:
+                zip_writers.close()
+        except BaseException:
+            self.upload_processor.cancel_background_upload()
+            raise
 
         logging.info("Uploading files.")
         self._send_data(table)
 
-    def _generate_metadata(self, table: TableDefinition):
-        expected_columns = ['slug', 'shop_id']
-        self._validate_expected_columns('metadata', table, expected_columns)
-
-        # Create a dictionary to store the zip files by shop_id
-        zip_files = {}
-
-        logging.info("Writing metadata json content.")
-        file_count = 0
-        zip_nr_suffix = 1
-        with open(table.full_path, 'r') as inp:
-            reader = csv.DictReader(inp)
-            for row in reader:
-                shop_id = row["shop_id"]
-
-                if shop_id not in zip_files:
-                    # Define the suffix for the zip file
-                    suffix = "_metadata_1"
-                    zip_filename = os.path.join(self.files_out_path, f'{shop_id}{suffix}.zip')
-                    zip_files[shop_id] = zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED)
-                    file_count = 0
-
-                # Remove the top-level folder by excluding the `{row["shop_id"]}` part
-                file_path = f'items/{row["shop_id"]}/{row["slug"]}/meta.json'
-                for c in expected_columns:
-                    row.pop(c, None)
-                content = self._generate_metadata_content(list(row.keys()), list(row.values()))
-
-                self._write_json_content_to_zip(zip_files[shop_id], file_path, content[0])
-
-                file_count += 1
-                if file_count >= MAX_FILES_PER_ZIP:
-                    # Close the current zip file and create a new one
-                    zip_files[shop_id].close()
-                    suffix = f"_metadata_{zip_nr_suffix}"
-                    zip_filename = os.path.join(self.files_out_path, f'{shop_id}{suffix}.zip')
-                    zip_files[shop_id] = zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED)
-                    file_count = 0
-                    zip_nr_suffix += 1
-
-        # Close the zip files
-        for zip_file in zip_files.values():
-            zip_file.close()
+    def _write_price_history_shard(self, shard_queue: queue.Queue, zip_writers: ShopZipWriterPool,
+                                   aborted: threading.Event):
+        """
+        Writes rows queued for one shard until the end of input. An error aborts all shards, the queue
+        is still drained so that the reading thread never blocks, and the error is raised at the end.
+        """
+        error = None
+        while True:
+            item = shard_queue.get()
+            if item is None:
+                break
+            if error is not None or aborted.is_set():
+                continue
+            shop_id, rows = item
+            try:
+                zip_writers.get(shop_id).write_entries(self._price_history_entries(shop_id, rows))
+            except Exception as e:
+                error = e
+                aborted.set()
 
-        logging.info("Uploading files.")
-        self._send_data(table)
+        if error is not None:
+            raise error
 
-    def __generate_price_history(self, table: TableDefinition):
-        expected_columns = ['shop_id', 'slug', 'json']
-        self._validate_expected_columns('pricehistory', table, expected_columns)
+    def _upload_archive(self, zip_path: str):
+        # archives are always written directly to the output folder
+        target_path = self.s3_bucket_dir + os.path.basename(zip_path)
+        self.upload_processor.upload_in_background(zip_path, target_path)
 
-        # Create a dictionary to store the zip files by shop_id
-        zip_files = {}
-        saved_files = 0
+    @staticmethod
+    def _entry_path_prefix(shop_id) -> str:
+        # all rows passed to the entry generators belong to a single shop, so the path prefix is built once
+        # Remove the top-level folder by excluding the `{shop_id}` part
+        return f'items/{shop_id}/'
 
-        logging.info("Writing json content.")
-        for row in self.read_csv_file(table.full_path):
-            shop_id = row["shop_id"]
-
-            if shop_id not in zip_files:
-                # Create the zip file with the desired filename
-                suffix = "_pricehistory"
-                zip_filename = os.path.join(self.files_out_path, f'{shop_id}{suffix}.zip')
-                zip_files[shop_id] = zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED)
-
-            # Remove the top-level folder by excluding the `{row["shop_id"]}` part
-            file_path = f'items/{row["shop_id"]}/{row["slug"]}/price-history.json'
-            content = json.loads(row['json'])
-            self._write_json_content_to_zip(zip_files[shop_id], file_path, content)
-            saved_files += 1
-
-        # Close the zip files
-        for zip_file in zip_files.values():
-            zip_file.close()
-
-        logging.info(f"Saved {saved_files} files.")
-        logging.info("Uploading files.")
-        self._send_data(table)
+    def _price_history_entries(self, shop_id, rows):
+        path_prefix = self._entry_path_prefix(shop_id)
+        for slug, json_str in rows:
+            file_path = f'{path_prefix}{slug}/price-history.json'
+            yield file_path, self._validated_json(file_path, json_str)
 
-    def __generate_metadata(self, table: TableDefinition):
+    def _generate_metadata(self, table: TableDefinition):
         expected_columns = ['slug', 'shop_id']
         self._validate_expected_columns('metadata', table, expected_columns)
 
-        # Create a dictionary to store the zip files by shop_id
-        zip_files = {}
-
-        logging.info("Writing metadata json content.")
-        with open(table.full_path, 'r') as inp:
-            reader = csv.DictReader(inp)
-            for row in reader:
-                shop_id = row["shop_id"]
-
-                if shop_id not in zip_files:
-                    # Create the zip file with the desired filename
-                    suffix = "_metadata"
-                    zip_filename = os.path.join(self.files_out_path, f'{shop_id}{suffix}.zip')
-                    zip_files[shop_id] = zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED)
-
-                # Remove the top-level folder by excluding the `{row["shop_id"]}` part
-                file_path = f'items/{row["shop_id"]}/{row["slug"]}/meta.json'
-                for c in expected_columns:
-                    row.pop(c, None)
-                content = self._generate_metadata_content(list(row.keys()), list(row.values()))
+        zip_writers = ShopZipWriterPool(self.files_out_path, 'metadata', MAX_FILES_PER_ZIP, MAX_OPEN_ZIPS,
+                                        compresslevel=self.compresslevel, on_close=self._upload_archive)
 
-                self._write_json_content_to_zip(zip_files[shop_id], file_path, content[0])
+        self.upload_processor.start_background_upload()
 
-        # Close the zip files
-        for zip_file in zip_files.values():
-            zip_file.close()
+        logging.info("Writing metadata json content.")
+        try:
+            with open(table.full_path, 'r', encoding='utf-8', newline='', buffering=CSV_READ_BUFFER) as inp:
+                reader = csv.reader(inp)
+                header = next(reader)
+                # repeated column names resolve to their last occurrence, same as with csv.DictReader
+                column_index = {c: i for i, c in enumerate(header)}
+                shop_idx = column_index['shop_id']
+                slug_idx = column_index['slug']
+                value_columns = [c for c in column_index if c not in expected_columns]
+                value_idx = [column_index[c] for c in value_columns]
+                # headers are identical for all rows, so a single converter is built for the whole table
+                converter = Csv2JsonConverter(headers=value_columns, delimiter='__')
+
+                # consecutive rows of the same shop are written to its archive in one go
+                for shop_id, rows in groupby(self._padded_rows(reader, len(header)), key=itemgetter(shop_idx)):
+                    zip_writers.get(shop_id).write_entries(
+                        self._metadata_entries(shop_id, rows, converter, slug_idx, value_idx))
+
+            # Close the zip files
+            zip_writers.close()
+        except BaseException:
+            self.upload_processor.cancel_background_upload()
+            raise
 
         logging.info("Uploading files.")
         self._send_data(table)
 
-    def _generate_metadata_content(self, columns, row: List[str]):
-        converter = Csv2JsonConverter(headers=columns, delimiter='__')
+    @staticmethod
+    def _padded_rows(reader, width: int):
+        """
+        Skips blank lines and pads short rows with None, the same way csv.DictReader does.
+        """
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < width:
+                row += [None] * (width - len(row))
+            yield row
+
+    def _metadata_entries(self, shop_id, rows, converter: Csv2JsonConverter, slug_idx: int, value_idx: List[int]):
+        path_prefix = self._entry_path_prefix(shop_id)
+        for row in rows:
+            file_path = f'{path_prefix}{row[slug_idx]}/meta.json'
+            content = self._generate_metadata_content(converter, [row[i] for i in value_idx])
+            yield file_path, self._dump_json(content[0])
+
+    @staticmethod
+    def _dump_json(content) -> bytes:
+        try:
+            return orjson.dumps(content)
+        except orjson.JSONEncodeError:
+            # orjson only supports 64-bit integers, longer numeric values are serialized by the json module
+            return json.dumps(content, ensure_ascii=False).encode('utf-8')
+
+    def _generate_metadata_content(self, converter: Csv2JsonConverter, row: List[str]):
         return converter.convert_row(row, coltypes=self.custom_mapping, delimit="__", infer_undefined=True)
 
     def _send_data(self, table):
         """
-        Sends data to S3 and cleans the output folder.
+        Waits until all archives of the table are sent to S3.
+        Archives are queued for upload with their target paths as soon as they are closed,
+        uploaded archives are removed from the output folder.
         """
         logging.info(f"Uploading data for table {table.name} to S3")
-        # CREATE LIST OF FILES IN OUTPUT FOLDER
-        self.local_paths, self.target_paths = self.upload_processor.prepare_lists_of_files(
-            self.files_out_path,
-            self.s3_bucket_dir)
-        # SEND FILES TO TARGET DIR IN S3
-        self.upload_processor.process_upload(self.local_paths, self.target_paths)
+        self.upload_processor.finish_background_upload()
 
     @staticmethod
-    def read_csv_file(file_path):
-        with open(file_path, 'r', encoding='utf-8') as inp:
-            reader = csv.DictReader(inp)
-            for row in reader:
-                yield row
+    def read_csv_batches(file_path, columns: List[str]):
+        """
+        Streams the selected columns of a CSV file in record batches and yields each batch as a list of columns.
+
+        All values are read as strings, empty values are kept as empty strings.
+        """
+        read_options = pac.ReadOptions(block_size=CSV_BLOCK_SIZE)
+        parse_options = pac.ParseOptions(newlines_in_values=True)
+        convert_options = pac.ConvertOptions(include_columns=columns,
+                                             column_types={c: pa.string() for c in columns})
+        with pac.open_csv(file_path, read_options=read_options, parse_options=parse_options,
+                          convert_options=convert_options) as reader:
+            # column positions are resolved once from the header instead of by name for every batch
+            column_idx = [reader.schema.get_field_index(c) for c in columns]
+            for batch in reader:
+                yield [batch.column(i).to_pylist() for i in column_idx]
 
 
 """
@@ -1,13 +1,14 @@
 import logging
 import boto3
 import os
+import queue
+import threading
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.client import Config
 
 # configuration variables
-KEY_FORMAT = 'format'
 AWS_SECRET_ACCESS_KEY = '#aws_secret_access_key'
 AWS_ACCESS_KEY_ID = 'aws_access_key_id'
-WORKERS = "workers"
-S3_BUCKET_DIR = "aws_directory"
 
 
 class S3Writer:
@@ -15,29 +16,110 @@ class S3Writer:
     This class handles the logic to upload files to AWS S3.
     """
 
-    def __init__(self, params, data_path, aws_bucket):
+    # The uploaded files are per-shop zip archives that can grow to hundreds of MB,
+    # so large archives are still split into parts uploaded in parallel.
+    MULTIPART_CONCURRENCY = 4
+    MULTIPART_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, params, data_path, aws_bucket, workers):
         super().__init__()
         self.aws_bucket = aws_bucket
         self.data_path = data_path
-        self.client = self.get_client_from_session(params)
+        self.workers = workers
+        self.client = self.get_client_from_session(params, workers)
+        # a single transfer manager schedules the requests of all uploads
+        self.transfer_manager = create_transfer_manager(
+            self.client, TransferConfig(multipart_threshold=self.MULTIPART_SIZE,
+                                        multipart_chunksize=self.MULTIPART_SIZE,
+                                        max_concurrency=workers * self.MULTIPART_CONCURRENCY,
+                                        use_threads=True))
         self.sent_files_counter = 0
+        self._counter_lock = threading.Lock()
+        self._upload_queue = None
+        self._upload_threads = []
+        self._upload_errors = []
+
+    def _increment_sent_files(self) -> None:
+        with self._counter_lock:
+            self.sent_files_counter += 1
+
+    def start_background_upload(self) -> None:
+        """
+        Starts worker threads that upload files passed to upload_in_background while they are being produced.
+        Every uploaded file is removed from the local disk.
+        """
+        self._upload_queue = queue.Queue(maxsize=self.workers)
+        self._upload_errors = []
+        self._upload_threads = [threading.Thread(target=self._background_upload_worker, daemon=True)
+                                for _ in range(self.workers)]
+        for thread in self._upload_threads:
+            thread.start()
+
+    def upload_in_background(self, local_path: str, target_path: str) -> None:
+        """
+        Queues a finished file for upload, blocks while all workers are busy and the queue is full.
+        """
+        self._upload_queue.put((local_path, target_path))
 
-    def process_upload(self, local_paths, target_paths):
+    def finish_background_upload(self) -> None:
         """
-        Uploads files to S3 storage.
+        Waits until all queued files are uploaded and stops the worker threads.
 
-        Returns: None
+        Raises:
+            The first error raised by any of the uploads.
         """
-        for file_to_upload, target_path in zip(local_paths, target_paths):
-            self.upload_one_file(self.aws_bucket, self.client, file_to_upload, target_path)
+        if self._upload_queue is None:
+            return
+        self._stop_upload_threads()
+        if self._upload_errors:
+            raise self._upload_errors[0]
+
+    def cancel_background_upload(self) -> None:
+        """
+        Drops the queued files that are not being uploaded yet, waits for the running uploads
+        and stops the worker threads. Errors of the running uploads are only logged.
+        """
+        if self._upload_queue is None:
+            return
+        try:
+            while True:
+                self._upload_queue.get_nowait()
+        except queue.Empty:
+            pass
+        self._stop_upload_threads()
+
+    def _stop_upload_threads(self) -> None:
+        for _ in self._upload_threads:
+            self._upload_queue.put(None)
+        for thread in self._upload_threads:
+            thread.join()
+        self._upload_queue = None
+        self._upload_threads = []
+
+    def _background_upload_worker(self) -> None:
+        while True:
+            item = self._upload_queue.get()
+            if item is None:
+                return
+            local_path, target_path = item
+            try:
+                self.upload_one_file(self.aws_bucket, local_path, target_path)
+                os.remove(local_path)
+                self._increment_sent_files()
+            except Exception as e:
+                logging.error(f"Upload of {local_path} failed: {e}")
+                self._upload_errors.append(e)
 
     @staticmethod
-    def get_client_from_session(params) -> boto3.Session.client:
+    def get_client_from_session(params, workers: int) -> boto3.Session.client:
         """
         Creates and returns boto3 client class.
+        The client is thread-safe and shared by all upload threads, its connection pool is sized
+        to fit every upload thread sending multipart parts concurrently.
 
         Args:
             params: Keboola json configuration parameters
+            workers: number of threads using the client
 
         Returns:
             boto3 client class
@@ -47,7 +129,10 @@ class S3Writer:
             aws_access_key_id=params.get(AWS_ACCESS_KEY_ID),
             aws_secret_access_key=params.get(AWS_SECRET_ACCESS_KEY)
         )
-        return session.client('s3')
+        config = Config(max_pool_connections=max(workers * S3Writer.MULTIPART_CONCURRENCY, 32),
+                        retries={'max_attempts': 10, 'mode': 'adaptive'},
+                        tcp_keepalive=True)
+        return session.client('s3', config=config)
 
     def test_connection_ok(self) -> bool:
         try:
@@ -58,37 +143,18 @@ class S3Writer:
             logging.warning(e)
             return False
 
-    @staticmethod
-    def prepare_lists_of_files(in_dir, out_dir):
+    def upload_one_file(self, bucket: str, local_file: str, target_path: str) -> None:
         """
-        Creates and populates lists with local paths to files and target paths
-
-        Returns:
-            Two lists representing files that will be sent and their destination
-
+        Upload a single file to S3 and wait until it is finished
         Args:
-            in_dir: input directory
-            out_dir: target S3 folder
+            bucket (str): S3 bucket to upload the file to
+            local_file (str): path to the local file
+            target_path (str): S3 key to store the file to
         """
+        self.transfer_manager.upload(local_file, bucket, target_path).result()
 
-        _local_paths, _target_paths = [], []
-        for root, dirs, files in os.walk(in_dir):
-            for name in files:
-                _local_paths.append(os.path.join(root, name))
-                _target_paths.append(out_dir + os.path.join(root, name).replace(in_dir, "")[1:])
-
-        return _local_paths, _target_paths
-
-    def upload_one_file(self, bucket: str, client: boto3.client, local_file: str, target_path: str) -> None:
+    def close(self) -> None:
         """
-        Download a single file from S3
-        Args:
-            bucket (str): S3 bucket where images are hosted
-            target_path (str): S3 dir to store the file to
-            client (boto3.client): S3 client
-            local_file (str): S3 file name
+        Shuts down the transfer manager and its threads.
         """
-        client.upload_file(
-            local_file, bucket, target_path
-        )
-        self.sent_files_counter += 1
+        self.transfer_manager.shutdown()
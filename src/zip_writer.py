@@ -0,0 +1,120 @@
+import logging
+import os
+import zipfile
+from collections import OrderedDict
+from itertools import chain, islice
+
+from isal import isal_zlib
+
+# ISA-L produces standard DEFLATE streams several times faster than zlib. zipfile creates its
+# compressors through the zlib module at write time, so swapping the module for the ISA-L drop-in
+# replacement switches the compression; crc32 is bound on import and still comes from zlib.
+# The patch applies to every zipfile user in the process.
+zipfile.zlib = isal_zlib
+
+
+class ShopZipWriter:
+    """
+    This class writes files of a single shop into zip archives.
+    A new archive is started every time the current one reaches max_files files.
+    """
+
+    def __init__(self, out_path: str, shop_id: str, suffix: str, max_files: int, compresslevel: int = None,
+                 on_close=None):
+        """
+        Args:
+            out_path (str): folder to store the archives to
+            shop_id (str): shop the archives belong to
+            suffix (str): archive name suffix, e.g. format name
+            max_files (int): maximum number of files per archive
+            compresslevel (int): DEFLATE level, None for the compressor default
+            on_close (callable): optional callback called with the path of every finished archive
+        """
+        self.out_path = out_path
+        self.shop_id = shop_id
+        self.suffix = suffix
+        self.max_files = max_files
+        self.compresslevel = compresslevel
+        self.on_close = on_close
+        self.zip_file = None
+        self.zip_nr = 0
+        self.file_count = 0
+
+    def write_entries(self, entries) -> None:
+        """
+        Writes (file path, data) pairs, rolling over to new archives as they fill up.
+        The archive capacity is checked once per archive instead of once per file.
+        Args:
+            entries: iterable of (file path, data) pairs
+        """
+        entries = iter(entries)
+        for first_entry in entries:
+            if self.zip_file is None or self.file_count >= self.max_files:
+                self._open_next_zip()
+            for file_path, data in islice(chain((first_entry,), entries), self.max_files - self.file_count):
+                self.zip_file.writestr(file_path, data)
+            self.file_count = len(self.zip_file.filelist)
+
+    def close(self) -> None:
+        if self.zip_file is not None:
+            self.zip_file.close()
+            if self.on_close is not None:
+                self.on_close(self.zip_file.filename)
+            self.zip_file = None
+
+    def _open_next_zip(self) -> None:
+        self.close()
+        self.zip_nr += 1
+        zip_filename = os.path.join(self.out_path, f'{self.shop_id}_{self.suffix}_{self.zip_nr}.zip')
+        self.zip_file = zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED, compresslevel=self.compresslevel)
+        self.file_count = 0
+
+
+class ShopZipWriterPool:
+    """
+    This class keeps a ShopZipWriter for every shop while limiting the number of open archives.
+    When more than max_open shops have an open archive, the archive of the least recently used shop is closed.
+    Further files of that shop go to its next numbered archive; a warning is logged the first time a shop
+    is split this way. Archives are only closed on eviction, so up to max_open archives stay open
+    even for inputs sorted by shop_id, which never split a shop.
+    """
+
+    def __init__(self, out_path: str, suffix: str, max_files: int, max_open: int, compresslevel: int = None,
+                 on_close=None):
+        self.out_path = out_path
+        self.suffix = suffix
+        self.max_files = max_files
+        self.max_open = max_open
+        self.compresslevel = compresslevel
+        self.on_close = on_close
+        self.writers = {}
+        self._recently_used = OrderedDict()
+        self._split_warned = False
+
+    def get(self, shop_id: str) -> ShopZipWriter:
+        """
+        Returns the writer of the shop, closing the archive of the least recently used shop if needed.
+        Must not be called while other threads write to the pool's writers.
+        """
+        writer = self.writers.get(shop_id)
+        if writer is None:
+            writer = ShopZipWriter(self.out_path, shop_id, self.suffix, self.max_files,
+                                   compresslevel=self.compresslevel, on_close=self.on_close)
+            self.writers[shop_id] = writer
+        elif writer.zip_file is None and writer.zip_nr > 0 and not self._split_warned:
+            # the archive of the shop was evicted earlier, its further files start a new archive
+            logging.warning(f"More than {self.max_open} {self.suffix} archives were open, files of shop {shop_id} "
+                            f"are split into more archives. Sort the input by shop_id to avoid splitting shops.")
+            self._split_warned = True
+
+        self._recently_used.pop(shop_id, None)
+        self._recently_used[shop_id] = writer
+        if len(self._recently_used) > self.max_open:
+            _, least_recently_used = self._recently_used.popitem(last=False)
+            least_recently_used.close()
+        return writer
+
+    def close(self) -> None:
+        for writer in self.writers.values():
+            writer.close()
+        self._recently_used.clear()
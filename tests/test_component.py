@@ -3,11 +3,17 @@ Created on 12. 11. 2018
 
 @author: esner
 '''
+import json
 import unittest
 import mock
 import os
+import tempfile
+import zipfile
 from freezegun import freeze_time
 
+from keboola.component.dao import TableDefinition
+from keboola.component.exceptions import UserException
+
 from component import Component
 
 
@@ -23,6 +29,98 @@ class TestComponent(unittest.TestCase):
             # comp = Component()
             # comp.run()
 
+    def _init_component(self, parameters):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, 'config.json'), 'w') as config:
+                json.dump({'parameters': {'#aws_secret_access_key': 'secret', 'aws_access_key_id': 'key',
+                                          'aws_bucket': 'bucket', 'format': 'metadata', **parameters}}, config)
+            with mock.patch.dict(os.environ, {'KBC_DATADIR': tmp_dir}):
+                return Component()
+
+    def test_workers_must_be_positive_integer(self):
+        self.assertEqual(self._init_component({}).workers, 16)
+        self.assertEqual(self._init_component({'workers': 4}).workers, 4)
+        for workers in [0, -1, '4', 4.0, True]:
+            with self.subTest(workers=workers), self.assertRaises(UserException):
+                self._init_component({'workers': workers})
+
+    def test_compresslevel_must_be_integer_level(self):
+        self.assertEqual(self._init_component({}).compresslevel, 1)
+        self.assertEqual(self._init_component({'compresslevel': 3}).compresslevel, 3)
+        for compresslevel in [True, 1.0, 4, -1, '1']:
+            with self.subTest(compresslevel=compresslevel), self.assertRaises(UserException):
+                self._init_component({'compresslevel': compresslevel})
+
+    def _mocked_component(self, data_path):
+        comp = Component.__new__(Component)
+        comp.data_folder_path = data_path
+        os.makedirs(comp.files_out_path)
+        comp.s3_bucket_dir = 'dir/'
+        comp.validate_json = True
+        comp.workers = 4
+        comp.compresslevel = 1
+        comp.upload_processor = mock.Mock()
+        return comp
+
+    def _price_history_table(self, tmp_dir, rows):
+        full_path = os.path.join(tmp_dir, 'prices.csv')
+        with open(full_path, 'w') as out:
+            out.write('shop_id,slug,json\n')
+            out.writelines(f'{shop_id},{slug},"{json_str}"\n' for shop_id, slug, json_str in rows)
+        return TableDefinition('prices.csv', full_path, columns=['shop_id', 'slug', 'json'])
+
+    def test_price_history_uploads_archive_of_every_shop(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            comp = self._mocked_component(tmp_dir)
+            rows = [(f'shop{i % 8}', f'slug{i}', '{}') for i in range(40)]
+            comp._generate_price_history(self._price_history_table(tmp_dir, rows))
+
+            uploaded = sorted(c.args[1] for c in comp.upload_processor.upload_in_background.call_args_list)
+            self.assertEqual(uploaded, sorted(f'dir/shop{i}_pricehistory_1.zip' for i in range(8)))
+            comp.upload_processor.finish_background_upload.assert_called_once()
+
+    def test_price_history_shard_error_uploads_nothing(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            comp = self._mocked_component(tmp_dir)
+            rows = [(f'shop{i % 8}', f'slug{i}', '{}') for i in range(40)] + [('shop0', 'broken', '{')]
+
+            with self.assertRaises(UserException):
+                comp._generate_price_history(self._price_history_table(tmp_dir, rows))
+
+            comp.upload_processor.upload_in_background.assert_not_called()
+            comp.upload_processor.cancel_background_upload.assert_called_once()
+            comp.upload_processor.finish_background_upload.assert_not_called()
+    def test_metadata_skips_blank_lines(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            comp = self._mocked_component(tmp_dir)
+            comp.custom_mapping = []
+            full_path = os.path.join(tmp_dir, 'metadata.csv')
+            with open(full_path, 'w') as out:
+                # repeated column names resolve to their last occurrence, same as with csv.DictReader
+                out.write('shop_id,slug,name,name\nczc,1,first,Tea\n\nczc,2,first,Coffee\n')
+            comp._generate_metadata(TableDefinition('metadata.csv', full_path,
+                                                    columns=['shop_id', 'slug', 'name', 'name']))
+
+            comp.upload_processor.upload_in_background.assert_called_once()
+            local_path, target_path = comp.upload_processor.upload_in_background.call_args.args
+            self.assertEqual(target_path, 'dir/czc_metadata_1.zip')
+            with zipfile.ZipFile(local_path) as archive:
+                self.assertEqual(archive.namelist(), ['items/czc/1/meta.json', 'items/czc/2/meta.json'])
+                self.assertEqual(json.loads(archive.read('items/czc/1/meta.json')), {'name': 'Tea'})
+                self.assertEqual(json.loads(archive.read('items/czc/2/meta.json')), {'name': 'Coffee'})
+
+    def test_padded_rows_match_dict_reader(self):
+        rows = [['czc', '1', 'Tea'], [], ['czc', '2'], ['czc']]
+        self.assertEqual(list(Component._padded_rows(iter(rows), 3)),
+                         [['czc', '1', 'Tea'], ['czc', '2', None], ['czc', None, None]])
+
+    def test_dump_json_falls_back_for_integers_outside_64_bits(self):
+        self.assertEqual(Component._dump_json({'id': 173052, 'name': 'Čaj'}),
+                         '{"id":173052,"name":"Čaj"}'.encode('utf-8'))
+        self.assertEqual(Component._dump_json({'id': 2 ** 64, 'name': 'Čaj'}),
+                         '{"id": 18446744073709551616, "name": "Čaj"}'.encode('utf-8'))
+
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from uploader.client import S3Writer
+
+
+class TestS3Writer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        params = {'aws_access_key_id': 'key', '#aws_secret_access_key': 'secret'}
+        self.writer = S3Writer(params, self.tmp_dir.name, aws_bucket='bucket', workers=1)
+
+    def tearDown(self):
+        self.writer.close()
+        self.tmp_dir.cleanup()
+
+    def _local_file(self, name):
+        local_path = os.path.join(self.tmp_dir.name, name)
+        with open(local_path, 'w') as out:
+            out.write(name)
+        return local_path
+
+    def test_background_upload_removes_uploaded_files(self):
+        with mock.patch.object(self.writer, 'upload_one_file') as upload_one_file:
+            self.writer.start_background_upload()
+            for name in ['a.zip', 'b.zip']:
+                self.writer.upload_in_background(self._local_file(name), f'dir/{name}')
+            self.writer.finish_background_upload()
+
+        self.assertEqual([c.args for c in upload_one_file.call_args_list],
+                         [('bucket', os.path.join(self.tmp_dir.name, name), f'dir/{name}')
+                          for name in ['a.zip', 'b.zip']])
+        self.assertEqual(self.writer.sent_files_counter, 2)
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+
+    def test_finish_raises_upload_error(self):
+        with mock.patch.object(self.writer, 'upload_one_file', side_effect=[ValueError('failed'), None]), \
+                self.assertLogs(level='ERROR'):
+            self.writer.start_background_upload()
+            for name in ['a.zip', 'b.zip']:
+                self.writer.upload_in_background(self._local_file(name), f'dir/{name}')
+            with self.assertRaisesRegex(ValueError, 'failed'):
+                self.writer.finish_background_upload()
+
+        self.assertEqual(self.writer.sent_files_counter, 1)
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['a.zip'])
+
+    def test_cancel_drops_queued_files(self):
+        uploading = threading.Event()
+        release = threading.Event()
+
+        def upload_one_file(bucket, local_file, target_path):
+            uploading.set()
+            release.wait(10)
+
+        with mock.patch.object(self.writer, 'upload_one_file', side_effect=upload_one_file) as upload_mock:
+            self.writer.start_background_upload()
+            self.writer.upload_in_background(self._local_file('a.zip'), 'dir/a.zip')
+            self.assertTrue(uploading.wait(10))
+            # the only worker is busy, so the second file waits in the queue
+            self.writer.upload_in_background(self._local_file('b.zip'), 'dir/b.zip')
+            upload_queue = self.writer._upload_queue
+
+            cancel = threading.Thread(target=self.writer.cancel_background_upload)
+            cancel.start()
+            # the running upload is released once the queued file was dropped for the stop signal
+            deadline = time.monotonic() + 10
+            while list(upload_queue.queue) != [None] and time.monotonic() < deadline:
+                time.sleep(0.01)
+            release.set()
+            cancel.join(10)
+
+        self.assertFalse(cancel.is_alive())
+        self.assertEqual(upload_mock.call_count, 1)
+        self.assertEqual(self.writer.sent_files_counter, 1)
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['b.zip'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+import zipfile
+from itertools import count
+
+from zip_writer import ShopZipWriter, ShopZipWriterPool
+
+
+# slugs are unique across the whole test module, so no archive ever gets a duplicate entry
+SLUGS = count()
+
+
+def entries(shop_id, size):
+    return ((f'items/{shop_id}/{next(SLUGS)}/meta.json', b'{}') for _ in range(size))
+
+
+class TestShopZipWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.out_path = self.tmp_dir.name
+        self.closed = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write_entries_rolls_over_at_max_files(self):
+        writer = ShopZipWriter(self.out_path, 'czc', 'metadata', 3, on_close=self.closed.append)
+        writer.write_entries(entries('czc', 7))
+        writer.close()
+
+        self.assertEqual([os.path.basename(p) for p in self.closed],
+                         ['czc_metadata_1.zip', 'czc_metadata_2.zip', 'czc_metadata_3.zip'])
+        self.assertEqual([len(zipfile.ZipFile(p).namelist()) for p in self.closed], [3, 3, 1])
+
+    def test_write_entries_continues_current_archive(self):
+        writer = ShopZipWriter(self.out_path, 'czc', 'metadata', 3, on_close=self.closed.append)
+        writer.write_entries(entries('czc', 2))
+        writer.write_entries(entries('czc', 2))
+        writer.close()
+
+        self.assertEqual([len(zipfile.ZipFile(p).namelist()) for p in self.closed], [3, 1])
+
+    def test_close_without_entries_creates_no_archive(self):
+        writer = ShopZipWriter(self.out_path, 'czc', 'metadata', 3, on_close=self.closed.append)
+        writer.write_entries([])
+        writer.close()
+
+        self.assertEqual(self.closed, [])
+        self.assertEqual(os.listdir(self.out_path), [])
+
+
+class TestShopZipWriterPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.out_path = self.tmp_dir.name
+        self.closed = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_evicts_least_recently_used_shop(self):
+        pool = ShopZipWriterPool(self.out_path, 'metadata', 10, 2, on_close=self.closed.append)
+        for shop_id in ['a', 'b', 'a', 'c']:
+            pool.get(shop_id).write_entries(entries(shop_id, 1))
+
+        self.assertEqual([os.path.basename(p) for p in self.closed], ['b_metadata_1.zip'])
+
+        # the evicted shop continues in its next archive
+        with self.assertLogs(level='WARNING'):
+            pool.get('b').write_entries(entries('b', 1))
+        pool.close()
+
+        self.assertEqual(sorted(os.path.basename(p) for p in self.closed),
+                         ['a_metadata_1.zip', 'b_metadata_1.zip', 'b_metadata_2.zip', 'c_metadata_1.zip'])
+
+    def test_sorted_input_is_not_split(self):
+        pool = ShopZipWriterPool(self.out_path, 'metadata', 10, 3, on_close=self.closed.append)
+        with self.assertNoLogs(level='WARNING'):
+            for shop_id in ['a', 'a', 'b', 'c', 'd', 'e', 'e']:
+                pool.get(shop_id).write_entries(entries(shop_id, 1))
+            pool.close()
+
+        self.assertEqual(sorted(os.path.basename(p) for p in self.closed),
+                         [f'{shop_id}_metadata_1.zip' for shop_id in 'abcde'])
+
+    def test_keeps_all_archives_open_within_limit(self):
+        pool = ShopZipWriterPool(self.out_path, 'metadata', 10, 3, on_close=self.closed.append)
+        for shop_id in ['a', 'b', 'c', 'a', 'b', 'c']:
+            pool.get(shop_id).write_entries(entries(shop_id, 1))
+
+        self.assertEqual(self.closed, [])
+        pool.close()
+        self.assertEqual(sorted(os.path.basename(p) for p in self.closed),
+                         ['a_metadata_1.zip', 'b_metadata_1.zip', 'c_metadata_1.zip'])
+
+
+if __name__ == "__main__":
+    unittest.main()